@@ -1,3 +1,4 @@
+using System.Drawing;
 using KvtmAuto.Core.Models;
 
 namespace KvtmAuto.Automation.Engine;
@@ -40,6 +41,12 @@ public abstract class ScriptBase(AdbController adb, ImageMatcher images, DeviceM
         (630, 1210),(920, 1210), (1210, 1210), (1500, 1210),
     ];
 
+    // Market slot states, in match priority: sold first, then empty
+    private static readonly string[] MarketSlotAssets = ["o-da-ban", "o-trong-ban"];
+
+    // Area around the 8 SellSlotPoint centres — slot search skips the rest of the screen
+    private static readonly Rectangle MarketSlotRegion = new(380, 540, 1370, 920);
+
     private static readonly (double x, double y)[] FriendHousePoint =
     [
         (590, 1470), (860, 1470), (1130, 1470), (1400, 1470), (1670, 1470),
@@ -127,22 +134,14 @@ public abstract class ScriptBase(AdbController adb, ImageMatcher images, DeviceM
 
     protected async Task GoUpAsync(string id, CancellationToken ct, int times = 1)
     {
-        for (int i = 0; i < times; i++)
-        {
-            await adb.SwipeAsync(id, 1160, 1050, 1160, 1700, 100);
-            await SleepAsync(0.1, ct);
-        }
-        await SleepAsync(0.5, ct);
+        await adb.SwipeRepeatAsync(id, 1160, 1050, 1160, 1700, 100, times, pauseMs: 100);
+        await SleepAsync(0.6, ct);
     }
 
     protected async Task GoDownAsync(string id, CancellationToken ct, int times = 1)
     {
-        for (int i = 0; i < times; i++)
-        {
-            await adb.SwipeAsync(id, 1160, 1050, 1160, 400, 100);
-            await SleepAsync(0.1, ct);
-        }
-        await SleepAsync(0.5, ct);
+        await adb.SwipeRepeatAsync(id, 1160, 1050, 1160, 400, 100, times, pauseMs: 100);
+        await SleepAsync(0.6, ct);
     }
 
     protected async Task GoLastAsync(string id, CancellationToken ct)
@@ -249,26 +248,21 @@ public abstract class ScriptBase(AdbController adb, ImageMatcher images, DeviceM
         {
             ct.ThrowIfCancellationRequested();
 
-            var soldSlot = await FindImageAsync(id, "o-da-ban", ct);
-            if (soldSlot is not null)
+            // One capture for both slot states; a sold slot still takes priority over an empty one
+            var slot = await FindFirstImageAsync(id, MarketSlotAssets, ct, roi: MarketSlotRegion);
+            if (slot is { } hit)
             {
-                await adb.TapAsync(id, soldSlot.Value.x, soldSlot.Value.y);
-                await SleepAsync(0.25, ct);
-                await adb.TapAsync(id, soldSlot.Value.x, soldSlot.Value.y);
-                await SleepAsync(0.25, ct);
-                await adb.TapAsync(id, chooseType.x, chooseType.y);
-                await SleepAsync(0.5, ct);
-                await ClickImageAsync(id, $"vat-pham/{item}", ct);
-                await SellAsync(id, ct);
-                item = GetRemainItem(items);
-                continue;
-            }
-
-            var emptySlot = await FindImageAsync(id, "o-trong-ban", ct);
-            if (emptySlot is not null)
-            {
-                await adb.TapAsync(id, emptySlot.Value.x, emptySlot.Value.y);
-                await SleepAsync(0.5, ct);
+                await adb.TapAsync(id, hit.x, hit.y);
+                if (hit.index == 0)
+                {
+                    await SleepAsync(0.25, ct);
+                    await adb.TapAsync(id, hit.x, hit.y);
+                    await SleepAsync(0.25, ct);
+                }
+                else
+                {
+                    await SleepAsync(0.5, ct);
+                }
                 await adb.TapAsync(id, chooseType.x, chooseType.y);
                 await SleepAsync(0.5, ct);
                 await ClickImageAsync(id, $"vat-pham/{item}", ct);
@@ -344,11 +338,7 @@ public abstract class ScriptBase(AdbController adb, ImageMatcher images, DeviceM
     private async Task SellAsync(string id, CancellationToken ct, bool setAds = true)
     {
         await SleepAsync(0.5, ct);
-        for (int i = 0; i < 10; i++)
-        {
-            await adb.TapAsync(id, 1835, 1020);
-            await SleepAsync(0.01, ct);
-        }
+        await adb.TapRepeatAsync(id, 1835, 1020, 10);
         await SleepAsync(0.5, ct);
 
         if (!setAds)
@@ -368,17 +358,30 @@ public abstract class ScriptBase(AdbController adb, ImageMatcher images, DeviceM
         await SleepAsync(0.5, ct);
     }
 
-    private async Task<(double x, double y)?> FindImageAsync(string deviceId, string assetPath, CancellationToken ct, double threshold = 0.9)
+    private async Task<(double x, double y)?> FindImageAsync(
+        string deviceId, string assetPath, CancellationToken ct, double threshold = 0.9, Rectangle? roi = null)
     {
         ct.ThrowIfCancellationRequested();
-        var screen = await adb.CaptureScreenAsync(deviceId);
+        using var screen = await adb.CaptureScreenAsync(deviceId);
+        if (screen is null) return null;
         // Run CPU-bound template matching on a dedicated thread to avoid blocking the ASP.NET thread pool
-        return await Task.Run(() => images.FindOnScreen(screen, assetPath, threshold), ct);
+        return await Task.Run(() => images.FindOnScreen(screen, assetPath, threshold, roi), ct);
+    }
+
+    /// <summary>Captures once and returns the first of <paramref name="assetPaths"/> found on screen.</summary>
+    private async Task<(int index, double x, double y)?> FindFirstImageAsync(
+        string deviceId, string[] assetPaths, CancellationToken ct, double threshold = 0.9, Rectangle? roi = null)
+    {
+        ct.ThrowIfCancellationRequested();
+        using var screen = await adb.CaptureScreenAsync(deviceId);
+        if (screen is null) return null;
+        return await Task.Run(() => images.FindFirstOnScreen(screen, assetPaths, threshold, roi), ct);
     }
 
-    private async Task<bool> ClickImageAsync(string deviceId, string assetPath, CancellationToken ct, double threshold = 0.9)
+    private async Task<bool> ClickImageAsync(
+        string deviceId, string assetPath, CancellationToken ct, double threshold = 0.9, Rectangle? roi = null)
     {
-        var pos = await FindImageAsync(deviceId, assetPath, ct, threshold);
+        var pos = await FindImageAsync(deviceId, assetPath, ct, threshold, roi);
         if (pos is null) return false;
         await adb.TapAsync(deviceId, pos.Value.x, pos.Value.y);
         return true;
@@ -1,3 +1,5 @@
+using System.Collections.Frozen;
+using System.Text;
 using KvtmAuto.Core.Models;
 using KvtmAuto.Hubs;
 using KvtmAuto.Infrastructure.Database;
@@ -16,13 +18,28 @@ public class DeviceManager(
     private readonly Dictionary<string, Device> _devices = [];
     private readonly Lock _lock = new();
 
+    // Set by UpdateDevice; flushed in one batch on the next poll tick instead of per mutation
+    private bool _dirty;
+
+    // True while adb track-devices is connected — polling then only flushes pending changes
+    private volatile bool _tracking;
+    private Task? _trackTask;
+    private readonly SemaphoreSlim _persistGate = new(1, 1);
+
+    // Per-device log files kept open and flushed on the poll tick, on read and on shutdown
+    private readonly Dictionary<string, StreamWriter> _logWriters = [];
+    private readonly Lock _logLock = new();
+    private bool _logsClosed; // set on shutdown; later entries are appended unbuffered
+
+    private static readonly string LogsDir = Path.Combine("data", "logs");
+
     // Friendly name map (serial → display name)
-    private static readonly Dictionary<string, string> NameMap = new()
+    private static readonly FrozenDictionary<string, string> NameMap = new Dictionary<string, string>
     {
         ["emulator-5554"] = "Kai",
         ["emulator-5564"] = "Cong Anh",
         ["emulator-5574"] = "My Hanh",
-    };
+    }.ToFrozenDictionary();
 
     public IReadOnlyList<Device> Devices
     {
@@ -39,26 +56,96 @@ public class DeviceManager(
         lock (_lock)
         {
             if (_devices.TryGetValue(id, out var device))
+            {
                 update(device);
+                _dirty = true;
+            }
         }
     }
 
     protected override async Task ExecuteAsync(CancellationToken stoppingToken)
     {
         await LoadFromDbAsync();
+        _trackTask = TrackAsync(stoppingToken);
 
         while (!stoppingToken.IsCancellationRequested)
         {
-            await DiscoverAsync();
+            if (_tracking)
+            {
+                // track-devices only reports changes — keep LastSeen current for devices still online
+                lock (_lock)
+                {
+                    foreach (var device in _devices.Values)
+                        if (device.Status != DeviceStatus.Offline) device.LastSeen = DateTime.UtcNow;
+                }
+                await FlushAsync();
+            }
+            else
+            {
+                await DiscoverAsync();
+            }
+            FlushLogs();
             await Task.Delay(_pollInterval, stoppingToken);
         }
     }
 
+    public override async Task StopAsync(CancellationToken cancellationToken)
+    {
+        await base.StopAsync(cancellationToken);
+
+        // The tracking loop may still be inside SyncAsync/PersistAsync — let it finish before
+        // the final flush. Bounded by the host's shutdown timeout like base.StopAsync.
+        if (_trackTask is not null)
+            await Task.WhenAny(_trackTask, Task.Delay(Timeout.Infinite, cancellationToken));
+        await FlushAsync();
+
+        lock (_logLock)
+        {
+            _logsClosed = true;
+            foreach (var writer in _logWriters.Values)
+                writer.Dispose();
+            _logWriters.Clear();
+        }
+    }
+
+    /// <summary>
+    /// Applies device snapshots pushed by the adb server as they arrive. Reconnects after
+    /// <see cref="_pollInterval"/> on failure; the poll loop covers discovery in the meantime.
+    /// </summary>
+    private async Task TrackAsync(CancellationToken ct)
+    {
+        while (!ct.IsCancellationRequested)
+        {
+            try
+            {
+                await foreach (var connected in adb.TrackDevicesAsync(ct))
+                {
+                    _tracking = true;
+                    await SyncAsync(connected);
+                }
+            }
+            catch (OperationCanceledException) when (ct.IsCancellationRequested)
+            {
+                return;
+            }
+            catch (Exception ex)
+            {
+                if (_tracking)
+                    logger.LogWarning(ex, "adb track-devices disconnected, falling back to polling");
+            }
+
+            _tracking = false;
+            try { await Task.Delay(_pollInterval, ct); }
+            catch (OperationCanceledException) { return; }
+        }
+    }
+
     private async Task LoadFromDbAsync()
     {
         using var scope = scopeFactory.CreateScope();
         var db = scope.ServiceProvider.GetRequiredService<AppDbContext>();
-        var saved = await db.Devices.ToListAsync();
+        // Read-only snapshot — no change tracking; the reset is a single UPDATE below
+        var saved = await db.Devices.AsNoTracking().ToListAsync();
         lock (_lock)
         {
             foreach (var d in saved)
@@ -68,7 +155,9 @@ public class DeviceManager(
                 _devices[d.Id] = d;
             }
         }
-        await db.SaveChangesAsync();
+        await db.Devices.ExecuteUpdateAsync(s => s
+            .SetProperty(d => d.Status, DeviceStatus.Offline)
+            .SetProperty(d => d.CurrentScriptId, (string?)null));
         logger.LogInformation("Loaded {Count} devices from DB", saved.Count);
     }
 
@@ -76,72 +165,99 @@ public class DeviceManager(
     {
         try
         {
-            var connected = await adb.GetDeviceIdsAsync();
-            var connectedSet = connected.ToHashSet();
-            var changed = false;
+            await SyncAsync(await adb.GetDeviceIdsAsync());
+        }
+        catch (Exception ex)
+        {
+            logger.LogError(ex, "Device discovery error");
+        }
+    }
 
-            lock (_lock)
+    private async Task SyncAsync(List<string> connected)
+    {
+        var connectedSet = connected.ToHashSet();
+        var changed = false;
+        List<string> wentOffline = [];
+
+        lock (_lock)
+        {
+            // Mark online / add new
+            foreach (var id in connected)
             {
-                // Mark online / add new
-                foreach (var id in connected)
+                if (!_devices.TryGetValue(id, out var device))
                 {
-                    if (!_devices.TryGetValue(id, out var device))
-                    {
-                        device = new Device
-                        {
-                            Id = id,
-                            Name = NameMap.GetValueOrDefault(id, id),
-                            Status = DeviceStatus.Online,
-                            LastSeen = DateTime.UtcNow,
-                        };
-                        _devices[id] = device;
-                        changed = true;
-                    }
-                    else
+                    device = new Device
                     {
-                        device.LastSeen = DateTime.UtcNow;
-                        if (device.Status == DeviceStatus.Offline)
-                        {
-                            device.Status = DeviceStatus.Online;
-                            changed = true;
-                        }
-                    }
+                        Id = id,
+                        Name = NameMap.GetValueOrDefault(id, id),
+                        Status = DeviceStatus.Online,
+                        LastSeen = DateTime.UtcNow,
+                    };
+                    _devices[id] = device;
+                    changed = true;
                 }
-
-                // Mark offline
-                foreach (var device in _devices.Values)
+                else
                 {
-                    if (!connectedSet.Contains(device.Id) && device.Status != DeviceStatus.Offline)
+                    device.LastSeen = DateTime.UtcNow;
+                    if (device.Status == DeviceStatus.Offline)
                     {
-                        device.Status = DeviceStatus.Offline;
+                        device.Status = DeviceStatus.Online;
                         changed = true;
                     }
                 }
             }
 
-            if (changed)
-                await PersistAsync();
-        }
-        catch (Exception ex)
-        {
-            logger.LogError(ex, "Device discovery error");
+            // Mark offline
+            foreach (var device in _devices.Values)
+            {
+                if (!connectedSet.Contains(device.Id) && device.Status != DeviceStatus.Offline)
+                {
+                    device.Status = DeviceStatus.Offline;
+                    wentOffline.Add(device.Id);
+                    changed = true;
+                }
+            }
+
+            changed |= _dirty;
         }
+
+        // Outside the lock — tearing down a shell session kills its adb process
+        foreach (var id in wentOffline)
+            adb.Invalidate(id);
+
+        if (changed)
+            await PersistAsync();
+    }
+
+    private async Task FlushAsync()
+    {
+        bool dirty;
+        lock (_lock) dirty = _dirty;
+        if (dirty)
+            await PersistAsync();
     }
 
     private async Task PersistAsync()
     {
+        // Discovery, tracking and shutdown can all persist — one writer at a time
+        await _persistGate.WaitAsync();
         try
         {
             using var scope = scopeFactory.CreateScope();
             var db = scope.ServiceProvider.GetRequiredService<AppDbContext>();
 
             List<Device> snapshot;
-            lock (_lock) snapshot = [.. _devices.Values];
+            lock (_lock)
+            {
+                snapshot = [.. _devices.Values];
+                _dirty = false;
+            }
+
+            var stored = await db.Devices.ToDictionaryAsync(d => d.Id);
 
             foreach (var device in snapshot)
             {
-                var existing = await db.Devices.FindAsync(device.Id);
-                if (existing is null)
+                if (!stored.TryGetValue(device.Id, out var existing))
                     db.Devices.Add(device);
                 else
                 {
@@ -156,17 +272,46 @@ public class DeviceManager(
         }
         catch (Exception ex)
         {
+            // The snapshot never reached disk — mark dirty again so the next tick retries
+            lock (_lock) _dirty = true;
             logger.LogError(ex, "Failed to persist device state");
         }
+        finally
+        {
+            _persistGate.Release();
+        }
     }
 
-    public void AppendLog(string deviceId, string message)
+    /// <summary>
+    /// Appends a line to the device log. Lines are buffered and flushed on the poll tick;
+    /// pass <paramref name="flush"/> for entries that must survive a crash (e.g. errors).
+    /// </summary>
+    public void AppendLog(string deviceId, string message, bool flush = false)
     {
-        var logsDir = Path.Combine("data", "logs");
-        Directory.CreateDirectory(logsDir);
-        var logFile = Path.Combine(logsDir, $"{deviceId}.log");
         var entry = $"[{DateTime.Now:HH:mm:ss}]: {message}";
-        File.AppendAllText(logFile, entry + Environment.NewLine);
+        lock (_logLock)
+        {
+            if (_logsClosed)
+            {
+                // Shutting down — don't open writers nothing will dispose
+                Directory.CreateDirectory(LogsDir);
+                File.AppendAllText(LogPath(deviceId), entry + Environment.NewLine);
+            }
+            else
+            {
+                if (!_logWriters.TryGetValue(deviceId, out var writer))
+                {
+                    Directory.CreateDirectory(LogsDir);
+                    // Shared so GetLogs can read while the file is held open for appends
+                    var stream = new FileStream(LogPath(deviceId), FileMode.Append, FileAccess.Write,
+                        FileShare.ReadWrite | FileShare.Delete, 64 * 1024);
+                    writer = new StreamWriter(stream);
+                    _logWriters[deviceId] = writer;
+                }
+                writer.WriteLine(entry);
+                if (flush) writer.Flush();
+            }
+        }
 
         // Push to any connected SignalR clients watching this device's logs
         _ = hub.Clients.Group($"logs-{deviceId}").SendAsync("ReceiveLog", entry);
@@ -174,15 +319,71 @@ public class DeviceManager(
 
     public string[] GetLogs(string deviceId, int limit = 100)
     {
-        var logFile = Path.Combine("data", "logs", $"{deviceId}.log");
+        lock (_logLock)
+        {
+            if (_logWriters.TryGetValue(deviceId, out var writer))
+                writer.Flush();
+        }
+
+        var logFile = LogPath(deviceId);
         if (!File.Exists(logFile)) return [];
-        var lines = File.ReadAllLines(logFile);
-        return lines.Length <= limit ? lines : lines[^limit..];
+        return ReadLastLines(logFile, limit);
     }
 
     public void ClearLogs(string deviceId)
     {
-        var logFile = Path.Combine("data", "logs", $"{deviceId}.log");
-        if (File.Exists(logFile)) File.Delete(logFile);
+        // Delete under the lock so a concurrent AppendLog can't reopen the file in between
+        lock (_logLock)
+        {
+            if (_logWriters.Remove(deviceId, out var writer))
+                writer.Dispose();
+
+            var logFile = LogPath(deviceId);
+            if (File.Exists(logFile)) File.Delete(logFile);
+        }
+    }
+
+    private void FlushLogs()
+    {
+        lock (_logLock)
+        {
+            foreach (var writer in _logWriters.Values)
+                writer.Flush();
+        }
+    }
+
+    /// <summary>
+    /// Reads only the end of the file — blocks are scanned backwards until more than
+    /// <paramref name="limit"/> newlines are covered, so cost doesn't grow with the log.
+    /// </summary>
+    private static string[] ReadLastLines(string path, int limit)
+    {
+        const int blockSize = 8 * 1024;
+        using var stream = new FileStream(path, FileMode.Open, FileAccess.Read, FileShare.ReadWrite | FileShare.Delete);
+
+        long end = stream.Length, start = end;
+        int newlines = 0;
+        var block = new byte[blockSize];
+        while (start > 0 && newlines <= limit)
+        {
+            int count = (int)Math.Min(blockSize, start);
+            start -= count;
+            stream.Position = start;
+            stream.ReadExactly(block, 0, count);
+            newlines += block.AsSpan(0, count).Count((byte)'\n');
+        }
+
+        var tail = new byte[end - start];
+        stream.Position = start;
+        stream.ReadExactly(tail);
+
+        var lines = Encoding.UTF8.GetString(tail).Split('\n');
+        // Mid-file start means the first piece is a partial line; the last is empty after a final newline
+        int first = start > 0 ? 1 : 0;
+        int last = lines[^1].Length == 0 ? lines.Length - 1 : lines.Length;
+        first = Math.Max(first, last - limit);
+        return [.. lines[first..last].Select(l => l.TrimEnd('\r'))];
     }
+
+    private static string LogPath(string deviceId) => Path.Combine(LogsDir, $"{deviceId}.log");
 }
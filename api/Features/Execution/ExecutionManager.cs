@@ -45,7 +45,7 @@ public class ExecutionManager(
             catch (Exception ex)
             {
                 logger.LogError(ex, "Script error for {DeviceId}", deviceId);
-                deviceManager.AppendLog(deviceId, $"Script error: {ex.Message}");
+                deviceManager.AppendLog(deviceId, $"Script error: {ex.Message}", flush: true);
                 deviceManager.UpdateDevice(deviceId, d =>
                 {
                     d.Status = DeviceStatus.Online;
@@ -111,11 +111,15 @@ public class ExecutionManager(
     {
         List<string> ids;
         lock (_lock) ids = [.. _running.Keys];
-        foreach (var id in ids)
-        {
-            try { await StopAsync(id); }
-            catch (Exception ex) { logger.LogWarning(ex, "Error stopping {DeviceId}", id); }
-        }
+
+        // Each device stops independently — wait for all at once instead of one timeout after another
+        await Task.WhenAll(ids.Select(StopQuietlyAsync));
+    }
+
+    private async Task StopQuietlyAsync(string deviceId)
+    {
+        try { await StopAsync(deviceId); }
+        catch (Exception ex) { logger.LogWarning(ex, "Error stopping {DeviceId}", deviceId); }
     }
 
     public bool IsRunning(string deviceId)
@@ -3,28 +3,38 @@ using KvtmAuto.Core.Models;
 
 namespace KvtmAuto.Features.Scripts;
 
-public class ScriptManager(AdbController adb, ImageMatcher images, DeviceManager deviceManager)
+public class ScriptManager
 {
-    private readonly List<IScript> _scripts =
-    [
-        new NuocHoaTao(adb, images, deviceManager),
-        new VaiXanhLa(adb, images, deviceManager),
-        new VaiTim(adb, images, deviceManager),
-        new TinhDauChanhVaiXanhLa(adb, images, deviceManager),
-        new TinhDauDuaTraHoaHong(adb, images, deviceManager),
-        new TrongCaySuKien(adb, images, deviceManager),
-        new MuaVpsk(adb, images, deviceManager),
-    ];
+    private readonly List<IScript> _scripts;
 
-    public IReadOnlyList<Script> Scripts =>
-        _scripts.Select(s => new Script { Id = s.Id, Name = s.Name }).ToList();
+    // The script set is fixed at construction — build the id index and DTO list once
+    private readonly Dictionary<string, IScript> _byId;
+    private readonly IReadOnlyList<Script> _scriptInfos;
+
+    public ScriptManager(AdbController adb, ImageMatcher images, DeviceManager deviceManager)
+    {
+        _scripts =
+        [
+            new NuocHoaTao(adb, images, deviceManager),
+            new VaiXanhLa(adb, images, deviceManager),
+            new VaiTim(adb, images, deviceManager),
+            new TinhDauChanhVaiXanhLa(adb, images, deviceManager),
+            new TinhDauDuaTraHoaHong(adb, images, deviceManager),
+            new TrongCaySuKien(adb, images, deviceManager),
+            new MuaVpsk(adb, images, deviceManager),
+        ];
+        _byId = _scripts.ToDictionary(s => s.Id);
+        _scriptInfos = _scripts.Select(s => new Script { Id = s.Id, Name = s.Name }).ToList();
+    }
+
+    public IReadOnlyList<Script> Scripts => _scriptInfos;
 
     public Script? GetScript(string id)
     {
-        var s = _scripts.FirstOrDefault(x => x.Id == id);
+        var s = _byId.GetValueOrDefault(id);
         return s is null ? null : new Script { Id = s.Id, Name = s.Name };
     }
 
     public IScript? GetIScript(string id) =>
-        _scripts.FirstOrDefault(s => s.Id == id);
+        _byId.GetValueOrDefault(id);
 }
@@ -1,119 +1,341 @@
-using System.Diagnostics;
 using Microsoft.AspNetCore.SignalR;
 
 namespace KvtmAuto.Hubs;
 
 public class ScreenHub(AdbController adb, IHubContext<ScreenHub> hubContext, ILogger<ScreenHub> logger) : Hub
 {
-    private static readonly Dictionary<string, CancellationTokenSource> ActiveStreams = [];
+    // One screenrecord producer per device, fanned out to every viewer through a SignalR group
+    private static readonly Dictionary<string, StreamProducer> Producers = [];
+    private static readonly Dictionary<string, string> ViewerDevices = []; // connectionId → deviceId
     private static readonly Lock StreamsLock = new();
 
+    private const int ReadBufferSize = 64 * 1024;
+    private const int AccumulatorCapacity = 256 * 1024;
+    private const int MaxPendingBytes = 1024 * 1024;
+
+    // A segment that exits sooner than this without being restarted counts as a failed start
+    // (exec-out folds screenrecord's error text into stdout, so "got bytes" is not enough)
+    private const long MinSegmentMs = 5000;
+    private const int MaxSegmentFailures = 3;
+    private static readonly TimeSpan SegmentRetryDelay = TimeSpan.FromSeconds(1);
+
     public async Task StartStream(string deviceId)
     {
         var connectionId = Context.ConnectionId;
+        StreamProducer? producer;
+        bool created = false;
 
         lock (StreamsLock)
         {
-            if (ActiveStreams.ContainsKey(connectionId)) return;
-            ActiveStreams[connectionId] = new CancellationTokenSource();
-        }
+            if (ViewerDevices.ContainsKey(connectionId)) return;
+            ViewerDevices[connectionId] = deviceId;
 
-        logger.LogInformation("Screen stream started for {DeviceId} (conn: {ConnId})", deviceId, connectionId);
-        _ = StreamAsync(deviceId, connectionId, ActiveStreams[connectionId].Token);
+            if (!Producers.TryGetValue(deviceId, out producer))
+            {
+                producer = new StreamProducer();
+                Producers[deviceId] = producer;
+                created = true;
+            }
+            producer.Viewers.Add(connectionId);
+        }
 
+        await Groups.AddToGroupAsync(connectionId, GroupName(deviceId));
         await Clients.Caller.SendAsync("StreamStarted", deviceId);
+
+        logger.LogInformation("Screen stream started for {DeviceId} (conn: {ConnId})", deviceId, connectionId);
+        if (created)
+            _ = StreamAsync(deviceId, producer);
+        else
+            RestartSegment(producer); // new viewer needs SPS/PPS + IDR to start decoding
     }
 
     public async Task StopStream(string deviceId)
     {
-        CancelStream(Context.ConnectionId);
+        RemoveViewer(Context.ConnectionId);
+        await Groups.RemoveFromGroupAsync(Context.ConnectionId, GroupName(deviceId));
         await Clients.Caller.SendAsync("StreamStopped", deviceId);
     }
 
     public override Task OnDisconnectedAsync(Exception? exception)
     {
-        CancelStream(Context.ConnectionId);
+        RemoveViewer(Context.ConnectionId);
         return base.OnDisconnectedAsync(exception);
     }
 
-    private async Task StreamAsync(string deviceId, string connectionId, CancellationToken ct)
+    private async Task StreamAsync(string deviceId, StreamProducer producer)
     {
-        Process? process = null;
-        int totalBytes = 0;
+        var ct = producer.Cts.Token;
+        var group = hubContext.Clients.Group(GroupName(deviceId));
+        long totalBytes = 0;
         try
         {
-            Stream stream;
-            (process, stream) = adb.OpenScreenRecordExecOutStream(deviceId);
-
-            var buffer = new byte[4096];
-            var accumulator = new List<byte>(65536);
-            int bytesRead;
+            var buffer = new byte[ReadBufferSize];
+            var accumulator = new FrameBuffer(AccumulatorCapacity);
 
-            while (!ct.IsCancellationRequested &&
-                   (bytesRead = await stream.ReadAsync(buffer, ct)) > 0)
+            // screenrecord exits at its --time-limit; respawn it within the same session.
+            // Each recording starts with SPS/PPS + IDR, so the client decoder re-syncs on its own.
+            int failures = 0;
+            while (!ct.IsCancellationRequested)
             {
-                totalBytes += bytesRead;
-                for (int j = 0; j < bytesRead; j++) accumulator.Add(buffer[j]);
+                var (end, segmentBytes) = await PumpScreenRecordAsync(deviceId, producer, group, buffer, accumulator);
+                totalBytes += segmentBytes;
 
-                int searchFrom = Math.Max(1, accumulator.Count - bytesRead - 4);
-                var nalIndex = FindNalBoundary(accumulator, searchFrom);
-                if (nalIndex > 0)
+                switch (end)
                 {
-                    var chunk = accumulator.Take(nalIndex).ToArray();
-                    accumulator.RemoveRange(0, nalIndex);
-                    await hubContext.Clients.Client(connectionId).SendAsync("ReceiveFrame", chunk, ct);
+                    case SegmentEnd.Restarted:
+                        // Killed mid-NAL for a new viewer — a partial tail would corrupt the decoder
+                        accumulator.Clear();
+                        failures = 0;
+                        continue;
+
+                    case SegmentEnd.Failed:
+                        accumulator.Clear();
+                        if (++failures >= MaxSegmentFailures)
+                        {
+                            logger.LogWarning("Screen record for {DeviceId} failed {Count} times, giving up", deviceId, failures);
+                            return;
+                        }
+                        logger.LogWarning("Screen record for {DeviceId} exited early, retrying", deviceId);
+                        await Task.Delay(SegmentRetryDelay * failures, ct);
+                        continue;
                 }
 
-                if (accumulator.Count > 1024 * 1024)
+                failures = 0;
+                if (accumulator.Length > 0)
                 {
-                    var chunk = accumulator.ToArray();
-                    accumulator.Clear();
-                    await hubContext.Clients.Client(connectionId).SendAsync("ReceiveFrame", chunk, ct);
+                    var tail = accumulator.TakeAll();
+                    await group.SendAsync("ReceiveFrame", tail, ct);
                 }
+
+                logger.LogInformation("Screen record segment ended for {DeviceId}, restarting", deviceId);
             }
         }
         catch (OperationCanceledException) { /* stopped intentionally */ }
         catch (Exception ex)
         {
             logger.LogError(ex, "Stream error for {DeviceId} ({Bytes} bytes)", deviceId, totalBytes);
-            try { await hubContext.Clients.Client(connectionId).SendAsync("StreamError", ex.Message, CancellationToken.None); } catch { }
+            try { await group.SendAsync("StreamError", ex.Message, CancellationToken.None); } catch { }
         }
         finally
         {
-            try { process?.Kill(); } catch { }
-            process?.Dispose();
-
             logger.LogInformation("Screen stream ended for {DeviceId} ({Bytes} bytes)", deviceId, totalBytes);
 
-            CancelStream(connectionId);
+            // Still registered means the stream ended on its own (not torn down by its last viewer)
+            List<string> viewers = [];
+            lock (StreamsLock)
+            {
+                if (Producers.TryGetValue(deviceId, out var current) && current == producer)
+                {
+                    Producers.Remove(deviceId);
+                    viewers = [.. producer.Viewers];
+                    foreach (var connectionId in viewers)
+                        ViewerDevices.Remove(connectionId);
+                    producer.Viewers.Clear();
+                }
+            }
+
+            if (viewers.Count > 0)
+            {
+                try { await group.SendAsync("StreamEnded", deviceId, CancellationToken.None); } catch { }
+                foreach (var connectionId in viewers)
+                {
+                    try { await hubContext.Groups.RemoveFromGroupAsync(connectionId, GroupName(deviceId)); } catch { }
+                }
+            }
 
-            try { await hubContext.Clients.Client(connectionId).SendAsync("StreamEnded", deviceId, CancellationToken.None); } catch { }
+            producer.Cts.Dispose();
         }
     }
 
-    private static void CancelStream(string connectionId)
+    /// <summary>
+    /// Runs one screenrecord process until it exits or the segment is restarted;
+    /// returns how the segment ended and the number of bytes read.
+    /// </summary>
+    private async Task<(SegmentEnd end, long bytes)> PumpScreenRecordAsync(
+        string deviceId, StreamProducer producer, IClientProxy group, byte[] buffer, FrameBuffer accumulator)
+    {
+        var ct = producer.Cts.Token;
+        using var segmentCts = CancellationTokenSource.CreateLinkedTokenSource(ct);
+
+        var (process, stream) = adb.OpenScreenRecordExecOutStream(deviceId);
+        long totalBytes = 0;
+        int chunksSent = 0;
+        long startedAt = Environment.TickCount64;
+        long statsAt = startedAt;
+        try
+        {
+            // Published only once the process is up, so the finally below always unpublishes it
+            lock (StreamsLock) producer.SegmentCts = segmentCts;
+
+            int bytesRead;
+            while (!segmentCts.Token.IsCancellationRequested &&
+                   (bytesRead = await stream.ReadAsync(buffer, segmentCts.Token)) > 0)
+            {
+                totalBytes += bytesRead;
+                accumulator.Append(buffer.AsSpan(0, bytesRead));
+
+                while (accumulator.TakeNal() is { } nal)
+                {
+                    await group.SendAsync("ReceiveFrame", nal, ct);
+                    chunksSent++;
+                }
+
+                if (accumulator.Length > MaxPendingBytes)
+                {
+                    var chunk = accumulator.TakeAll();
+                    await group.SendAsync("ReceiveFrame", chunk, ct);
+                    chunksSent++;
+                }
+
+                // Time-gated so the per-read path never formats log output unless debug is on
+                if (logger.IsEnabled(LogLevel.Debug) && Environment.TickCount64 - statsAt >= 1000)
+                {
+                    logger.LogDebug("Stream {DeviceId}: sent {Chunks} chunks ({Bytes} bytes)", deviceId, chunksSent, totalBytes);
+                    statsAt = Environment.TickCount64;
+                }
+            }
+        }
+        catch (OperationCanceledException) when (!ct.IsCancellationRequested)
+        {
+            // Segment restarted for a new viewer — handled below
+        }
+        finally
+        {
+            lock (StreamsLock) producer.SegmentCts = null;
+            try { process.Kill(); } catch { }
+            process.Dispose();
+        }
+
+        ct.ThrowIfCancellationRequested();
+        if (segmentCts.IsCancellationRequested)
+            return (SegmentEnd.Restarted, totalBytes);
+
+        bool failed = totalBytes == 0 || Environment.TickCount64 - startedAt < MinSegmentMs;
+        return (failed ? SegmentEnd.Failed : SegmentEnd.Ended, totalBytes);
+    }
+
+    private static void RestartSegment(StreamProducer producer)
+    {
+        lock (StreamsLock) producer.SegmentCts?.Cancel();
+    }
+
+    private static void RemoveViewer(string connectionId)
     {
         lock (StreamsLock)
         {
-            if (ActiveStreams.TryGetValue(connectionId, out var cts))
+            if (!ViewerDevices.Remove(connectionId, out var deviceId)) return;
+            if (!Producers.TryGetValue(deviceId, out var producer)) return;
+
+            producer.Viewers.Remove(connectionId);
+            if (producer.Viewers.Count == 0)
             {
-                cts.Cancel();
-                cts.Dispose();
-                ActiveStreams.Remove(connectionId);
+                // Last viewer gone — tear down the producer
+                Producers.Remove(deviceId);
+                producer.Cts.Cancel();
             }
         }
     }
 
-    private static int FindNalBoundary(List<byte> data, int startFrom)
+    private static string GroupName(string deviceId) => $"screen-{deviceId}";
+
+    private static ReadOnlySpan<byte> StartCode => [0x00, 0x00, 0x01];
+
+    private static int FindNalBoundary(ReadOnlySpan<byte> data, int startFrom)
+    {
+        // Span.IndexOf is SIMD-vectorized; a 4-byte start code (00 00 00 01) ends in the 3-byte one
+        int idx = data[startFrom..].IndexOf(StartCode);
+        if (idx < 0) return -1;
+
+        // A NAL never ends in 0x00, so a preceding zero is the leading byte of a 4-byte start code
+        int i = startFrom + idx;
+        return i > 0 && data[i - 1] == 0x00 ? i - 1 : i;
+    }
+
+    private enum SegmentEnd { Ended, Restarted, Failed }
+
+    private sealed class StreamProducer
+    {
+        public CancellationTokenSource Cts { get; } = new();
+        public HashSet<string> Viewers { get; } = [];
+        public CancellationTokenSource? SegmentCts { get; set; }
+    }
+
+    /// <summary>
+    /// Growable byte buffer for Annex-B data — block copies instead of per-byte appends.
+    /// Taken bytes only advance a head offset; the remainder is moved to the front once per append.
+    /// </summary>
+    private sealed class FrameBuffer(int capacity)
     {
-        for (int i = startFrom; i < data.Count - 3; i++)
+        private byte[] _data = new byte[capacity];
+        private int _head;
+        private int _scanFrom = 1; // relative to _head
+
+        public int Length { get; private set; }
+
+        public ReadOnlySpan<byte> Span => _data.AsSpan(_head, Length);
+
+        public void Append(ReadOnlySpan<byte> bytes)
         {
-            if (data[i] == 0x00 && data[i + 1] == 0x00)
+            if (_head > 0)
+            {
+                _data.AsSpan(_head, Length).CopyTo(_data);
+                _head = 0;
+            }
+            if (Length + bytes.Length > _data.Length)
+                Array.Resize(ref _data, Math.Max(_data.Length * 2, Length + bytes.Length));
+            bytes.CopyTo(_data.AsSpan(Length));
+            Length += bytes.Length;
+        }
+
+        /// <summary>
+        /// Removes the next complete NAL unit, or returns null if none is complete yet.
+        /// The search cursor only moves forward, so each byte is scanned once.
+        /// </summary>
+        public byte[]? TakeNal()
+        {
+            if (_scanFrom >= Length) return null;
+
+            int boundary = FindNalBoundary(Span, _scanFrom);
+            if (boundary == 0)
+            {
+                // 4-byte start code at the very front — resume past it
+                _scanFrom = 4;
+                return TakeNal();
+            }
+            if (boundary < 0)
             {
-                if (data[i + 2] == 0x01) return i;
-                if (i + 3 < data.Count && data[i + 2] == 0x00 && data[i + 3] == 0x01) return i;
+                // Back off so a start code split across reads is still found
+                _scanFrom = Math.Max(_scanFrom, Length - 3);
+                return null;
             }
+
+            var nal = Take(boundary);
+            _scanFrom = 3; // past the start code now at the front
+            return nal;
+        }
+
+        /// <summary>Drops any pending bytes, e.g. the partial NAL left by a killed segment.</summary>
+        public void Clear()
+        {
+            _head = 0;
+            Length = 0;
+            _scanFrom = 1;
+        }
+
+        public byte[] TakeAll()
+        {
+            _scanFrom = 1;
+            return Take(Length);
+        }
+
+        /// <summary>Copies out the first <paramref name="count"/> bytes and advances the head past them.</summary>
+        private byte[] Take(int count)
+        {
+            var chunk = _data.AsSpan(_head, count).ToArray();
+            _head += count;
+            Length -= count;
+            if (Length == 0) _head = 0;
+            return chunk;
         }
-        return -1;
     }
 }
@@ -14,7 +14,7 @@ public class AppDbContext(DbContextOptions<AppDbContext> options) : DbContext(op
         modelBuilder.Entity<Execution>()
             .Property(e => e.Options)
             .HasConversion(
-                v => JsonSerializer.Serialize(v, JsonSerializerOptions.Default),
-                v => JsonSerializer.Deserialize<GameOptions>(v, JsonSerializerOptions.Default));
+                v => JsonSerializer.Serialize(v, DbJsonContext.Default.GameOptions),
+                v => JsonSerializer.Deserialize(v, DbJsonContext.Default.GameOptions));
     }
 }
@@ -0,0 +1,11 @@
+using System.Text.Json.Serialization;
+using KvtmAuto.Core.Models;
+
+namespace KvtmAuto.Infrastructure.Database;
+
+/// <summary>
+/// Source-generated serializer metadata for JSON-backed columns — avoids
+/// reflection-based (de)serialization on every row read/write.
+/// </summary>
+[JsonSerializable(typeof(GameOptions))]
+public partial class DbJsonContext : JsonSerializerContext;
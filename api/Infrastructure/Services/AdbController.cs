@@ -1,9 +1,17 @@
+using System.Buffers;
+using System.Buffers.Binary;
+using System.Collections.Concurrent;
 using System.Diagnostics;
+using System.Globalization;
+using System.Net;
+using System.Net.Sockets;
+using System.Runtime.CompilerServices;
 using System.Text;
+using System.Text.RegularExpressions;
 
 namespace KvtmAuto.Infrastructure.Services;
 
-public class AdbController()
+public partial class AdbController(ILogger<AdbController> logger) : IDisposable
 {
     // BlueStacks Virtual Touch uses 0-32767 coordinate range
     private const int DeviceMaxX = 32767;
@@ -20,34 +28,139 @@ public class AdbController()
     private const int SynReport = 0;
     private const int SynMtReport = 2;
 
+    // android.graphics.PixelFormat values reported in the raw screencap header
+    private const int PixelFormatBgra8888 = 5;
+
+    // Local adb server, queried directly for device listing and tracking
+    private const int AdbServerPort = 5037;
+
+    // Covers a cold `adb devices`, which starts the server first
+    private static readonly TimeSpan DeviceListTimeout = TimeSpan.FromSeconds(10);
+
+    // Resolved once — Process.Start would otherwise search PATH on every spawn
+    private static readonly string AdbPath = ResolveAdbPath();
+
+    // Devices whose raw framebuffer can't be wrapped directly; they use PNG capture until reconnected
+    private readonly ConcurrentDictionary<string, byte> _pngCaptureDevices = [];
+
+    // One persistent `adb shell` per device for text commands (tap, swipe, keyevent, ...)
+    private readonly Dictionary<string, AdbShellSession> _sessions = [];
+    private readonly Lock _sessionsLock = new();
+
     // -------------------------------------------------------------------
     // Device discovery
     // -------------------------------------------------------------------
 
     public async Task<List<string>> GetDeviceIdsAsync()
     {
-        var (stdout, _) = await RunAsync("devices");
-        var ids = new List<string>();
-        foreach (var line in stdout.Split('\n').Skip(1))
+        // Bounded so a wedged adb server can't stall discovery; throws OperationCanceledException
+        using var cts = new CancellationTokenSource(DeviceListTimeout);
+
+        // Ask the adb server directly; spawn the client only when the server is not up yet,
+        // since `adb devices` also starts it
+        try
         {
-            var parts = line.Trim().Split('\t');
-            if (parts.Length == 2 && parts[1].Trim() == "device")
-                ids.Add(parts[0].Trim());
+            using var client = await ConnectHostAsync("host:devices", cts.Token);
+            return ParseDeviceList(await ReadMessageAsync(client.GetStream(), cts.Token));
         }
-        return ids;
+        catch (Exception ex) when (ex is SocketException or IOException)
+        {
+            var (stdout, _) = await RunAsync("devices", cts.Token);
+            return ParseDeviceList(stdout);
+        }
+    }
+
+    /// <summary>
+    /// Streams online device ids from the adb server (<c>host:track-devices</c>): one snapshot on
+    /// connect, then one per state change. Throws if the server is unreachable or drops the stream.
+    /// </summary>
+    public async IAsyncEnumerable<List<string>> TrackDevicesAsync([EnumeratorCancellation] CancellationToken ct)
+    {
+        using var client = await ConnectHostAsync("host:track-devices", ct);
+        var stream = client.GetStream();
+
+        while (true)
+            yield return ParseDeviceList(await ReadMessageAsync(stream, ct));
     }
 
     // -------------------------------------------------------------------
     // Screen capture
     // -------------------------------------------------------------------
 
-    public async Task<byte[]> CaptureScreenAsync(string deviceId)
+    /// <summary>
+    /// Captures the screen for image matching. Uses the raw framebuffer (<c>screencap</c> without
+    /// <c>-p</c>), which skips the on-device PNG encode and the host-side decode; devices whose
+    /// framebuffer isn't 32bpp (e.g. RGB_565) fall back to a PNG capture. Returns null if the
+    /// capture fails. The caller must dispose the frame to return its buffer to the pool.
+    /// </summary>
+    public async Task<ScreenFrame?> CaptureScreenAsync(string deviceId)
+    {
+        if (!_pngCaptureDevices.ContainsKey(deviceId))
+        {
+            var frame = await CaptureRawAsync(deviceId);
+            // Not switched to PNG means the capture itself came back empty — nothing to fall back to
+            if (frame is not null || !_pngCaptureDevices.ContainsKey(deviceId))
+                return frame;
+        }
+
+        var png = await CapturePngAsync(deviceId);
+        return png.Length > 0 ? ScreenFrame.FromPng(png) : null;
+    }
+
+    private async Task<ScreenFrame?> CaptureRawAsync(string deviceId)
     {
         using var process = new Process
         {
             StartInfo = new ProcessStartInfo
             {
-                FileName = "adb",
+                FileName = AdbPath,
+                Arguments = $"-s {deviceId} exec-out screencap",
+                RedirectStandardOutput = true,
+                UseShellExecute = false,
+                CreateNoWindow = true,
+            }
+        };
+        process.Start();
+
+        // Pooled buffer — a multi-MB frame per capture would otherwise land on the LOH every time
+        var buffer = ArrayPool<byte>.Shared.Rent(DefaultScreenWidth * DefaultScreenHeight * 4 + 16);
+        ScreenFrame? frame = null;
+        try
+        {
+            var stream = process.StandardOutput.BaseStream;
+            int length = 0, read;
+            while ((read = await stream.ReadAsync(buffer.AsMemory(length))) > 0)
+            {
+                length += read;
+                if (length == buffer.Length)
+                {
+                    var larger = ArrayPool<byte>.Shared.Rent(buffer.Length * 2);
+                    buffer.AsSpan(0, length).CopyTo(larger);
+                    ArrayPool<byte>.Shared.Return(buffer);
+                    buffer = larger;
+                }
+            }
+            await process.WaitForExitAsync();
+            frame = ParseRawScreen(buffer, length, out int format);
+            if (frame is null && length > 0 && _pngCaptureDevices.TryAdd(deviceId, 0))
+                logger.LogWarning(
+                    "Raw screencap from {DeviceId} is not a 32bpp frame (format {Format}, {Bytes} bytes), falling back to PNG capture",
+                    deviceId, format, length);
+            return frame;
+        }
+        finally
+        {
+            if (frame is null) ArrayPool<byte>.Shared.Return(buffer);
+        }
+    }
+
+    private static async Task<byte[]> CapturePngAsync(string deviceId)
+    {
+        using var process = new Process
+        {
+            StartInfo = new ProcessStartInfo
+            {
+                FileName = AdbPath,
                 Arguments = $"-s {deviceId} exec-out screencap -p",
                 RedirectStandardOutput = true,
                 UseShellExecute = false,
@@ -68,7 +181,7 @@ public class AdbController()
         {
             StartInfo = new ProcessStartInfo
             {
-                FileName = "adb",
+                FileName = AdbPath,
                 Arguments = $"-s {deviceId} exec-out screenrecord --output-format=h264 --bit-rate={bitRate} --time-limit={timeLimit} -",
                 RedirectStandardOutput = true,
                 RedirectStandardError = true,
@@ -87,12 +200,34 @@ public class AdbController()
     public async Task TapAsync(string deviceId, double x, double y)
     {
         // Supports both pixel coords (>1) and percentage coords (0.0-1.0)
-        await RunAsync($"-s {deviceId} shell input tap {(int)x} {(int)y}");
+        await ShellAsync(deviceId, $"input tap {(int)x} {(int)y}");
+    }
+
+    /// <summary>Taps the same point several times in a single adb shell invocation.</summary>
+    public async Task TapRepeatAsync(string deviceId, double x, double y, int times)
+    {
+        if (times <= 0) return;
+        var tap = $"input tap {(int)x} {(int)y}";
+        await ShellAsync(deviceId, string.Join("; ", Enumerable.Repeat(tap, times)));
     }
 
     public async Task SwipeAsync(string deviceId, double x1, double y1, double x2, double y2, int durationMs = 300)
     {
-        await RunAsync($"-s {deviceId} shell input swipe {(int)x1} {(int)y1} {(int)x2} {(int)y2} {durationMs}");
+        await ShellAsync(deviceId, $"input swipe {(int)x1} {(int)y1} {(int)x2} {(int)y2} {durationMs}");
+    }
+
+    /// <summary>
+    /// Repeats a swipe in a single adb shell invocation, pausing on-device between swipes.
+    /// </summary>
+    public async Task SwipeRepeatAsync(
+        string deviceId, double x1, double y1, double x2, double y2, int durationMs, int times, int pauseMs = 0)
+    {
+        if (times <= 0) return;
+        var swipe = $"input swipe {(int)x1} {(int)y1} {(int)x2} {(int)y2} {durationMs}";
+        var separator = pauseMs > 0
+            ? $"; sleep {(pauseMs / 1000.0).ToString("0.###", CultureInfo.InvariantCulture)}; "
+            : "; ";
+        await ShellAsync(deviceId, string.Join(separator, Enumerable.Repeat(swipe, times)));
     }
 
     /// <summary>
@@ -104,7 +239,8 @@ public class AdbController()
         if (points.Length < 2)
             throw new ArgumentException("Need at least 2 points for drag");
 
-        var sb = new StringBuilder();
+        // Four ~40-char sendevent commands per point, plus the release block
+        var sb = new StringBuilder((points.Length + 1) * 4 * 40);
         foreach (var (x, y) in points)
         {
             var (dx, dy) = ToDeviceCoords(x, y, screenWidth, screenHeight);
@@ -124,23 +260,45 @@ public class AdbController()
 
     public async Task KeyEventAsync(string deviceId, int keycode)
     {
-        await RunAsync($"-s {deviceId} shell input keyevent {keycode}");
+        await ShellAsync(deviceId, $"input keyevent {keycode}");
     }
 
     public async Task StartAppAsync(string deviceId, string package)
     {
-        await RunAsync($"-s {deviceId} shell monkey -p {package} -c android.intent.category.LAUNCHER 1");
+        await ShellAsync(deviceId, $"monkey -p {package} -c android.intent.category.LAUNCHER 1");
     }
 
     public async Task StopAppAsync(string deviceId, string package)
     {
-        await RunAsync($"-s {deviceId} shell am force-stop {package}");
+        await ShellAsync(deviceId, $"am force-stop {package}");
     }
 
+    /// <summary>
+    /// Runs a shell command through the device's persistent <see cref="AdbShellSession"/>.
+    /// If the session is broken before the command is sent it is dropped and the command falls back
+    /// to a one-shot adb call; once sent, the command is never replayed.
+    /// </summary>
     public async Task<string> ShellAsync(string deviceId, string command)
     {
-        var (stdout, _) = await RunAsync($"-s {deviceId} shell \"{command.Replace("\"", "\\\"")}\"");
-        return stdout;
+        AdbShellSession? session = null;
+        try
+        {
+            session = GetSession(deviceId);
+            return await session.ExecuteAsync(command);
+        }
+        catch (Exception ex) when (ex is TimeoutException or ShellCommandInterruptedException)
+        {
+            // The command may have run or still be running on the device — drop the session but don't replay it
+            if (session is not null) DropSession(deviceId, session);
+            throw;
+        }
+        catch (Exception ex) when (ex is IOException or InvalidOperationException or ObjectDisposedException
+                                       or System.ComponentModel.Win32Exception)
+        {
+            if (session is not null) DropSession(deviceId, session);
+            var (stdout, _) = await RunAsync($"-s {deviceId} shell \"{command.Replace("\"", "\\\"")}\"");
+            return stdout;
+        }
     }
 
     // -------------------------------------------------------------------
@@ -149,18 +307,45 @@ public class AdbController()
 
     public async Task<(int width, int height)> GetScreenSizeAsync(string deviceId)
     {
-        var (stdout, _) = await RunAsync($"-s {deviceId} shell wm size");
-        // "Physical size: 2160x1858"
-        var part = stdout.Split(':').LastOrDefault()?.Trim();
-        if (part is not null)
+        var stdout = await ShellAsync(deviceId, "wm size");
+        // "Physical size: 2160x1858" plus an "Override size: ..." line when one is set — prefer it
+        Match? size = null;
+        foreach (Match m in ScreenSizeRegex().Matches(stdout))
         {
-            var dims = part.Split('x');
-            if (dims.Length == 2 && int.TryParse(dims[0], out var w) && int.TryParse(dims[1], out var h))
-                return (w, h);
+            if (size is null || m.Groups[1].ValueSpan is "Override")
+                size = m;
         }
+        if (size is not null &&
+            int.TryParse(size.Groups[2].ValueSpan, out var w) && int.TryParse(size.Groups[3].ValueSpan, out var h))
+            return (w, h);
         return (DefaultScreenWidth, DefaultScreenHeight);
     }
 
+    /// <summary>Drops per-device state (capture mode, shell session) — call when a device disconnects.</summary>
+    public void Invalidate(string deviceId)
+    {
+        _pngCaptureDevices.TryRemove(deviceId, out _);
+
+        AdbShellSession? session;
+        lock (_sessionsLock)
+        {
+            if (!_sessions.Remove(deviceId, out session)) return;
+        }
+        session.Dispose();
+    }
+
+    public void Dispose()
+    {
+        List<AdbShellSession> sessions;
+        lock (_sessionsLock)
+        {
+            sessions = [.. _sessions.Values];
+            _sessions.Clear();
+        }
+        foreach (var session in sessions)
+            session.Dispose();
+    }
+
     // -------------------------------------------------------------------
     // Internal helpers
     // -------------------------------------------------------------------
@@ -173,13 +358,132 @@ public class AdbController()
         return ((int)(px * DeviceMaxX), (int)(py * DeviceMaxY));
     }
 
-    private async Task<(string stdout, int exitCode)> RunAsync(string args)
+    [GeneratedRegex(@"(Override|Physical) size:\s*(\d+)x(\d+)")]
+    private static partial Regex ScreenSizeRegex();
+
+    private AdbShellSession GetSession(string deviceId)
+    {
+        lock (_sessionsLock)
+        {
+            if (_sessions.TryGetValue(deviceId, out var session) && session.IsAlive)
+                return session;
+
+            session?.Dispose();
+            session = new AdbShellSession(AdbPath, deviceId);
+            _sessions[deviceId] = session;
+            return session;
+        }
+    }
+
+    private void DropSession(string deviceId, AdbShellSession session)
+    {
+        lock (_sessionsLock)
+        {
+            if (_sessions.TryGetValue(deviceId, out var current) && current == session)
+                _sessions.Remove(deviceId);
+        }
+        session.Dispose();
+    }
+
+    private static List<string> ParseDeviceList(string text)
+    {
+        var ids = new List<string>();
+        // "List of devices attached" header has no tab, so it is skipped along with blank lines
+        foreach (var line in text.AsSpan().EnumerateLines())
+        {
+            int tab = line.IndexOf('\t');
+            if (tab > 0 && line[(tab + 1)..].Trim() is "device")
+                ids.Add(line[..tab].Trim().ToString());
+        }
+        return ids;
+    }
+
+    /// <summary>Opens a host service on the local adb server and checks its OKAY reply.</summary>
+    private static async Task<TcpClient> ConnectHostAsync(string request, CancellationToken ct)
+    {
+        var client = new TcpClient();
+        try
+        {
+            await client.ConnectAsync(IPAddress.Loopback, AdbServerPort, ct);
+            var stream = client.GetStream();
+
+            // Requests are framed with their length as 4 hex digits
+            await stream.WriteAsync(Encoding.ASCII.GetBytes($"{request.Length:x4}{request}"), ct);
+
+            var status = await ReadStringAsync(stream, 4, ct);
+            if (status != "OKAY")
+                throw new IOException($"adb server rejected {request}: {status}");
+            return client;
+        }
+        catch
+        {
+            client.Dispose();
+            throw;
+        }
+    }
+
+    /// <summary>Reads one adb server reply payload, prefixed with its length as 4 hex digits.</summary>
+    private static async Task<string> ReadMessageAsync(Stream stream, CancellationToken ct)
+    {
+        int length = int.Parse(await ReadStringAsync(stream, 4, ct), NumberStyles.HexNumber, CultureInfo.InvariantCulture);
+        return await ReadStringAsync(stream, length, ct);
+    }
+
+    private static async Task<string> ReadStringAsync(Stream stream, int length, CancellationToken ct)
+    {
+        var buffer = new byte[length];
+        await stream.ReadExactlyAsync(buffer, ct);
+        return Encoding.UTF8.GetString(buffer);
+    }
+
+    private static ScreenFrame? ParseRawScreen(byte[] data, int length, out int format)
+    {
+        // Header: width, height, pixel format (+ color space on Android 9+), little-endian int32
+        format = -1;
+        if (length < 12) return null;
+        int width = BinaryPrimitives.ReadInt32LittleEndian(data.AsSpan(0, 4));
+        int height = BinaryPrimitives.ReadInt32LittleEndian(data.AsSpan(4, 4));
+        format = BinaryPrimitives.ReadInt32LittleEndian(data.AsSpan(8, 4));
+        if (width <= 0 || height <= 0) return null;
+
+        long headerSize = length - (long)width * height * 4;
+        if (headerSize != 12 && headerSize != 16) return null;
+
+        return new ScreenFrame(width, height, format == PixelFormatBgra8888, data, (int)headerSize);
+    }
+
+    private static string ResolveAdbPath()
+    {
+        var fileName = OperatingSystem.IsWindows() ? "adb.exe" : "adb";
+        var paths = Environment.GetEnvironmentVariable("PATH")?.Split(Path.PathSeparator) ?? [];
+        foreach (var dir in paths)
+        {
+            if (string.IsNullOrEmpty(dir)) continue;
+            var candidate = Path.Combine(dir, fileName);
+            // Skip non-executable matches the same way Process.Start's PATH search does
+            if (IsExecutable(candidate)) return candidate;
+        }
+        // Not on PATH — let Process.Start apply its own lookup on every spawn
+        return "adb";
+    }
+
+    private static bool IsExecutable(string path)
+    {
+        if (!File.Exists(path)) return false;
+        if (OperatingSystem.IsWindows()) return true;
+
+        const UnixFileMode anyExecute =
+            UnixFileMode.UserExecute | UnixFileMode.GroupExecute | UnixFileMode.OtherExecute;
+        return (File.GetUnixFileMode(path) & anyExecute) != 0;
+    }
+
+    private async Task<(string stdout, int exitCode)> RunAsync(string args, CancellationToken ct = default)
     {
         using var process = new Process
         {
             StartInfo = new ProcessStartInfo
             {
-                FileName = "adb",
+                FileName = AdbPath,
                 Arguments = args,
                 RedirectStandardOutput = true,
                 RedirectStandardError = true,
@@ -189,8 +493,16 @@ public class AdbController()
             }
         };
         process.Start();
-        var stdout = await process.StandardOutput.ReadToEndAsync();
-        await process.WaitForExitAsync();
-        return (stdout, process.ExitCode);
+        try
+        {
+            var stdout = await process.StandardOutput.ReadToEndAsync(ct);
+            await process.WaitForExitAsync(ct);
+            return (stdout, process.ExitCode);
+        }
+        catch (OperationCanceledException)
+        {
+            try { process.Kill(); } catch { }
+            throw;
+        }
     }
 }
@@ -0,0 +1,126 @@
+using System.Diagnostics;
+using System.Text;
+
+namespace KvtmAuto.Infrastructure.Services;
+
+/// <summary>
+/// Long-lived <c>adb -s {id} shell</c> process. Commands are written to its stdin and output
+/// is read up to a per-command end marker, so each call skips spawning a new adb client.
+/// Calls are serialized; a session that fails or times out mid-command must be disposed.
+/// Failures after the command was sent surface as <see cref="TimeoutException"/> or
+/// <see cref="ShellCommandInterruptedException"/>, since the command may already have run.
+/// </summary>
+public sealed class AdbShellSession : IDisposable
+{
+    private readonly Process _process;
+    private readonly SemaphoreSlim _gate = new(1, 1);
+    private long _sequence;
+    private byte[] _buffer = new byte[4096]; // reused across commands, guarded by _gate
+
+    // Cancelled on Dispose so queued and in-flight callers fail fast instead of waiting on a dead session
+    private readonly CancellationTokenSource _disposeCts = new();
+    private int _disposed;
+
+    private static readonly TimeSpan DefaultTimeout = TimeSpan.FromSeconds(30);
+
+    public AdbShellSession(string adbPath, string deviceId)
+    {
+        _process = new Process
+        {
+            StartInfo = new ProcessStartInfo
+            {
+                FileName = adbPath,
+                Arguments = $"-s {deviceId} shell",
+                RedirectStandardInput = true,
+                RedirectStandardOutput = true,
+                UseShellExecute = false,
+                CreateNoWindow = true,
+            }
+        };
+        _process.Start();
+    }
+
+    public bool IsAlive => Volatile.Read(ref _disposed) == 0 && !_process.HasExited;
+
+    public async Task<string> ExecuteAsync(string command, TimeSpan? timeout = null)
+    {
+        ObjectDisposedException.ThrowIf(Volatile.Read(ref _disposed) != 0, this);
+        try
+        {
+            await _gate.WaitAsync(_disposeCts.Token);
+        }
+        catch (OperationCanceledException)
+        {
+            throw new ObjectDisposedException(nameof(AdbShellSession));
+        }
+
+        try
+        {
+            var marker = $"__KVTM_END_{++_sequence}__";
+            // Brace group so stderr of the whole command is discarded, like the one-shot path
+            await _process.StandardInput.WriteAsync($"{{ {command}\n}} 2>/dev/null\necho {marker}\n");
+            await _process.StandardInput.FlushAsync();
+
+            try
+            {
+                // Block reads with a byte search for the marker line. Output without a trailing
+                // newline runs into the marker, so only the marker's own newline is matched.
+                var markerBytes = Encoding.ASCII.GetBytes(marker + "\n");
+                var stdout = _process.StandardOutput.BaseStream;
+                using var cts = CancellationTokenSource.CreateLinkedTokenSource(_disposeCts.Token);
+                cts.CancelAfter(timeout ?? DefaultTimeout);
+                int length = 0, scanFrom = 0;
+                while (true)
+                {
+                    if (length == _buffer.Length)
+                        Array.Resize(ref _buffer, _buffer.Length * 2);
+
+                    int read;
+                    try
+                    {
+                        read = await stdout.ReadAsync(_buffer.AsMemory(length), cts.Token);
+                    }
+                    catch (OperationCanceledException) when (_disposeCts.IsCancellationRequested)
+                    {
+                        throw new ObjectDisposedException(nameof(AdbShellSession));
+                    }
+                    catch (OperationCanceledException)
+                    {
+                        throw new TimeoutException($"adb shell command timed out: {command}");
+                    }
+                    if (read == 0) throw new IOException("adb shell session closed");
+                    length += read;
+
+                    int idx = _buffer.AsSpan(scanFrom, length - scanFrom).IndexOf(markerBytes);
+                    if (idx >= 0)
+                        return Encoding.UTF8.GetString(_buffer, 0, scanFrom + idx);
+
+                    // Keep enough of the tail to catch a marker split across reads
+                    scanFrom = Math.Max(0, length - markerBytes.Length + 1);
+                }
+            }
+            catch (Exception ex) when (ex is IOException or ObjectDisposedException or InvalidOperationException)
+            {
+                // Already sent — the command may have run, so the caller must not replay it
+                throw new ShellCommandInterruptedException(command, ex);
+            }
+        }
+        finally
+        {
+            // The session may have been torn down while this command was in flight
+            try { _gate.Release(); } catch (ObjectDisposedException) { }
+        }
+    }
+
+    public void Dispose()
+    {
+        // Mark disposed and wake every waiter before the gate goes away
+        if (Interlocked.Exchange(ref _disposed, 1) != 0) return;
+        _disposeCts.Cancel();
+
+        try { _process.Kill(); } catch { }
+        _process.Dispose();
+        _gate.Dispose();
+        _disposeCts.Dispose();
+    }
+}
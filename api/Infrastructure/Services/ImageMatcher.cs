@@ -1,4 +1,6 @@
+using System.Collections.Concurrent;
 using System.Drawing;
+using System.Runtime.InteropServices;
 using Emgu.CV;
 using Emgu.CV.CvEnum;
 
@@ -13,69 +15,245 @@ public class ImageMatcher(IConfiguration config, ILogger<ImageMatcher> logger)
     private readonly string _assetsDir = Path.GetFullPath(
         Path.Combine(AppContext.BaseDirectory, config["AssetsDir"] ?? "Automation/Assets"));
 
+    // Decoded templates (all rotations, full and coarse scale) keyed by full path;
+    // the file's write time invalidates stale entries
+    private readonly ConcurrentDictionary<string, TemplateSet> _templates = [];
+
     private static readonly RotateFlags?[] Rotations =
         [null, RotateFlags.Rotate90Clockwise, RotateFlags.Rotate180, RotateFlags.Rotate90CounterClockwise];
 
-    public (double x, double y)? FindOnScreen(byte[] screenshotPng, string assetRelPath, double threshold = 0.9)
+    // Coarse-to-fine search. Downscaling blurs detail, so the coarse pass uses a relaxed gate
+    // and the final score always comes from the full-resolution refine.
+    private const double CoarseScale = 0.5;
+    private const double CoarseMargin = 0.2;
+    private const int MinCoarseTemplateSize = 16;
+    private const int RefinePadding = 8;
+
+    /// <summary>
+    /// Matches against a captured frame — raw frames are wrapped in place, no PNG decode.
+    /// An optional <paramref name="roi"/> restricts the search; coordinates stay screen-relative.
+    /// </summary>
+    public (double x, double y)? FindOnScreen(ScreenFrame frame, string assetRelPath, double threshold = 0.9, Rectangle? roi = null)
     {
         try
         {
-            var templatePath = ResolveAsset(assetRelPath);
-            if (!File.Exists(templatePath))
+            using var screenMat = ToBgr(frame, roi, out var origin);
+            if (screenMat is null) return null;
+
+            using var screenSmall = Downscale(screenMat);
+            return Match(screenMat, screenSmall, assetRelPath, threshold) is { } pos
+                ? (pos.x + origin.X, pos.y + origin.Y)
+                : null;
+        }
+        catch (Exception ex)
+        {
+            logger.LogError(ex, "ImageMatcher error for {Asset}", assetRelPath);
+            return null;
+        }
+    }
+
+    /// <summary>
+    /// Matches several templates against one frame, converting and downscaling the screen once.
+    /// Returns the first template (in list order) that reaches the threshold, with its index.
+    /// </summary>
+    public (int index, double x, double y)? FindFirstOnScreen(
+        ScreenFrame frame, IReadOnlyList<string> assetRelPaths, double threshold = 0.9, Rectangle? roi = null)
+    {
+        try
+        {
+            using var screenMat = ToBgr(frame, roi, out var origin);
+            if (screenMat is null) return null;
+
+            using var screenSmall = Downscale(screenMat);
+            for (int i = 0; i < assetRelPaths.Count; i++)
+            {
+                if (Match(screenMat, screenSmall, assetRelPaths[i], threshold) is { } pos)
+                    return (i, pos.x + origin.X, pos.y + origin.Y);
+            }
+            return null;
+        }
+        catch (Exception ex)
+        {
+            logger.LogError(ex, "ImageMatcher error for {Assets}", string.Join(", ", assetRelPaths));
+            return null;
+        }
+    }
+
+    private static Rectangle Clip(int width, int height, Rectangle? roi)
+    {
+        var full = new Rectangle(0, 0, width, height);
+        return roi is { } r ? Rectangle.Intersect(r, full) : full;
+    }
+
+    /// <summary>
+    /// Converts the <paramref name="roi"/> part of the frame to BGR; <paramref name="origin"/> is its
+    /// top-left on screen. Returns null when the region is empty or the frame can't be decoded.
+    /// </summary>
+    private static Mat? ToBgr(ScreenFrame frame, Rectangle? roi, out Point origin)
+    {
+        if (frame.IsPng)
+        {
+            var decoded = new Mat();
+            CvInvoke.Imdecode(frame.Data, ImreadModes.ColorBgr, decoded);
+            var area = Clip(decoded.Width, decoded.Height, roi);
+            origin = area.Location;
+            if (area.IsEmpty)
             {
-                logger.LogWarning("Asset not found: {Path}", templatePath);
+                decoded.Dispose();
                 return null;
             }
+            if (area.Size == decoded.Size) return decoded;
+
+            using (decoded)
+            using (var cropped = new Mat(decoded, area))
+                return cropped.Clone();
+        }
+
+        var region = Clip(frame.Width, frame.Height, roi);
+        origin = region.Location;
+        if (region.IsEmpty) return null;
+
+        // Only the region is converted — the raw Mat strides over the full rows
+        var handle = GCHandle.Alloc(frame.Data, GCHandleType.Pinned);
+        try
+        {
+            int stride = frame.Width * 4;
+            using var raw = new Mat(region.Height, region.Width, DepthType.Cv8U, 4,
+                handle.AddrOfPinnedObject() + frame.Offset + region.Y * stride + region.X * 4, stride);
+            var screenMat = new Mat();
+            CvInvoke.CvtColor(raw, screenMat, frame.IsBgra ? ColorConversion.Bgra2Bgr : ColorConversion.Rgba2Bgr);
+            return screenMat;
+        }
+        finally
+        {
+            handle.Free();
+        }
+    }
+
+    private static Mat Downscale(Mat screenMat)
+    {
+        var screenSmall = new Mat();
+        if (!screenMat.IsEmpty)
+            CvInvoke.Resize(screenMat, screenSmall, Size.Empty, CoarseScale, CoarseScale, Inter.Area);
+        return screenSmall;
+    }
 
-            using var screenMat = new Mat();
-            CvInvoke.Imdecode(screenshotPng, ImreadModes.ColorBgr, screenMat);
+    private (double x, double y)? Match(Mat screenMat, Mat screenSmall, string assetRelPath, double threshold)
+    {
+        var templateFile = new FileInfo(ResolveAsset(assetRelPath));
+        if (!templateFile.Exists)
+        {
+            logger.LogWarning("Asset not found: {Path}", templateFile.FullName);
+            return null;
+        }
 
-            using var templateBase = CvInvoke.Imread(templatePath, ImreadModes.ColorBgr);
+        var templates = LoadTemplate(templateFile);
 
-            if (screenMat.IsEmpty || templateBase.IsEmpty) return null;
+        if (screenMat.IsEmpty || templates is null) return null;
 
-            double bestScore = double.MinValue;
-            int bestX = 0, bestY = 0, bestW = templateBase.Width, bestH = templateBase.Height;
+        double bestScore = double.MinValue;
+        int bestX = 0, bestY = 0, bestW = 0, bestH = 0;
 
-            foreach (var rotation in Rotations)
+        for (int i = 0; i < templates.Variants.Length; i++)
+        {
+            var template = templates.Variants[i];
+            if (template.Width > screenMat.Width || template.Height > screenMat.Height) continue;
+
+            var (maxVal, maxLoc) = MatchCoarseToFine(screenMat, screenSmall, template, templates.Coarse[i], threshold);
+
+            // Early termination — same as Python
+            if (maxVal >= threshold)
+                return (maxLoc.X + template.Width / 2.0, maxLoc.Y + template.Height / 2.0);
+
+            if (maxVal > bestScore)
             {
-                using var template = new Mat();
-                if (rotation is null)
-                    templateBase.CopyTo(template);
-                else
-                    CvInvoke.Rotate(templateBase, template, rotation.Value);
-
-                if (template.Width > screenMat.Width || template.Height > screenMat.Height) continue;
-
-                using var result = new Mat();
-                CvInvoke.MatchTemplate(screenMat, template, result, TemplateMatchingType.CcoeffNormed);
-
-                double minVal = 0, maxVal = 0;
-                var minLoc = new Point();
-                var maxLoc = new Point();
-                CvInvoke.MinMaxLoc(result, ref minVal, ref maxVal, ref minLoc, ref maxLoc);
-
-                // Early termination — same as Python
-                if (maxVal >= threshold)
-                    return (maxLoc.X + template.Width / 2.0, maxLoc.Y + template.Height / 2.0);
-
-                if (maxVal > bestScore)
-                {
-                    bestScore = maxVal;
-                    bestX = maxLoc.X;
-                    bestY = maxLoc.Y;
-                    bestW = template.Width;
-                    bestH = template.Height;
-                }
+                bestScore = maxVal;
+                bestX = maxLoc.X;
+                bestY = maxLoc.Y;
+                bestW = template.Width;
+                bestH = template.Height;
             }
-
-            return bestScore >= threshold ? (bestX + bestW / 2.0, bestY + bestH / 2.0) : null;
         }
-        catch (Exception ex)
+
+        return bestScore >= threshold ? (bestX + bestW / 2.0, bestY + bestH / 2.0) : null;
+    }
+
+    /// <summary>
+    /// Matches at <see cref="CoarseScale"/> first, then re-matches at full resolution only in a
+    /// small window around the coarse peak. Falls back to a full-resolution pass for templates
+    /// too small to survive downscaling.
+    /// </summary>
+    private static (double score, Point loc) MatchCoarseToFine(
+        Mat screen, Mat screenSmall, Mat template, Mat? templateSmall, double threshold)
+    {
+        if (templateSmall is null ||
+            templateSmall.Width > screenSmall.Width || templateSmall.Height > screenSmall.Height)
+            return MatchBest(screen, template);
+
+        var (coarseScore, coarseLoc) = MatchBest(screenSmall, templateSmall);
+        if (coarseScore < threshold - CoarseMargin) return (coarseScore, coarseLoc);
+
+        int x = Math.Max(0, (int)(coarseLoc.X / CoarseScale) - RefinePadding);
+        int y = Math.Max(0, (int)(coarseLoc.Y / CoarseScale) - RefinePadding);
+        int w = Math.Min(screen.Width - x, template.Width + 2 * RefinePadding);
+        int h = Math.Min(screen.Height - y, template.Height + 2 * RefinePadding);
+        if (w < template.Width || h < template.Height)
+            return MatchBest(screen, template);
+
+        using var window = new Mat(screen, new Rectangle(x, y, w, h));
+        var (score, loc) = MatchBest(window, template);
+        return (score, new Point(loc.X + x, loc.Y + y));
+    }
+
+    private static (double score, Point loc) MatchBest(Mat image, Mat template)
+    {
+        using var result = new Mat();
+        CvInvoke.MatchTemplate(image, template, result, TemplateMatchingType.CcoeffNormed);
+
+        double minVal = 0, maxVal = 0;
+        var minLoc = new Point();
+        var maxLoc = new Point();
+        CvInvoke.MinMaxLoc(result, ref minVal, ref maxVal, ref minLoc, ref maxLoc);
+        return (maxVal, maxLoc);
+    }
+
+    /// <summary>
+    /// Decodes a template once, along with its rotations and their coarse-scale copies,
+    /// and reuses them until the file changes on disk.
+    /// </summary>
+    private TemplateSet? LoadTemplate(FileInfo file)
+    {
+        var writeTime = file.LastWriteTimeUtc;
+        if (_templates.TryGetValue(file.FullName, out var cached) && cached.WriteTime == writeTime)
+            return cached;
+
+        using var template = CvInvoke.Imread(file.FullName, ImreadModes.ColorBgr);
+        if (template.IsEmpty) return null;
+
+        var variants = new Mat[Rotations.Length];
+        var coarse = new Mat?[Rotations.Length];
+        for (int i = 0; i < Rotations.Length; i++)
         {
-            logger.LogError(ex, "ImageMatcher error for {Asset}", assetRelPath);
-            return null;
+            var variant = new Mat();
+            if (Rotations[i] is { } rotation)
+                CvInvoke.Rotate(template, variant, rotation);
+            else
+                template.CopyTo(variant);
+            variants[i] = variant;
+
+            var smallSize = new Size((int)(variant.Width * CoarseScale), (int)(variant.Height * CoarseScale));
+            if (smallSize.Width >= MinCoarseTemplateSize && smallSize.Height >= MinCoarseTemplateSize)
+            {
+                var small = new Mat();
+                CvInvoke.Resize(variant, small, smallSize, interpolation: Inter.Area);
+                coarse[i] = small;
+            }
         }
+
+        // A replaced entry is left to its finalizer — another matcher thread may still be reading it
+        var entry = new TemplateSet(writeTime, variants, coarse);
+        _templates[file.FullName] = entry;
+        return entry;
     }
 
     private string ResolveAsset(string path)
@@ -89,4 +267,7 @@ public class ImageMatcher(IConfiguration config, ILogger<ImageMatcher> logger)
 
         return resolved;
     }
+
+    /// <summary>A template's rotations; <see cref="Coarse"/> is null where the downscaled copy is too small.</summary>
+    private sealed record TemplateSet(DateTime WriteTime, Mat[] Variants, Mat?[] Coarse);
 }
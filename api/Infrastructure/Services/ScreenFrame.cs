@@ -0,0 +1,45 @@
+using System.Buffers;
+
+namespace KvtmAuto.Infrastructure.Services;
+
+/// <summary>
+/// Captured screen. Normally a raw framebuffer from <c>screencap</c> (no <c>-p</c>): 4 bytes per
+/// pixel starting at <see cref="Offset"/> in <see cref="Data"/>, RGBA unless <see cref="IsBgra"/>,
+/// with <see cref="Data"/> rented from <see cref="ArrayPool{T}.Shared"/> — disposing the frame returns it.
+/// When <see cref="IsPng"/> is set, <see cref="Data"/> is an encoded PNG fallback and the size is unknown until decoded.
+/// </summary>
+public sealed class ScreenFrame : IDisposable
+{
+    private int _disposed;
+
+    public ScreenFrame(int width, int height, bool isBgra, byte[] data, int offset)
+    {
+        Width = width;
+        Height = height;
+        IsBgra = isBgra;
+        Data = data;
+        Offset = offset;
+    }
+
+    private ScreenFrame(byte[] png)
+    {
+        Data = png;
+        IsPng = true;
+    }
+
+    public static ScreenFrame FromPng(byte[] png) => new(png);
+
+    public int Width { get; }
+    public int Height { get; }
+    public bool IsBgra { get; }
+    public bool IsPng { get; }
+    public byte[] Data { get; }
+    public int Offset { get; }
+
+    public void Dispose()
+    {
+        // Returning the same array twice would hand it to two renters
+        if (Interlocked.Exchange(ref _disposed, 1) == 0 && !IsPng)
+            ArrayPool<byte>.Shared.Return(Data);
+    }
+}
@@ -0,0 +1,8 @@
+namespace KvtmAuto.Infrastructure.Services;
+
+/// <summary>
+/// A command was written to an <see cref="AdbShellSession"/> but the session failed before its
+/// output arrived, so it may already have run on the device. Callers must not replay it.
+/// </summary>
+public sealed class ShellCommandInterruptedException(string command, Exception innerException)
+    : Exception($"adb shell session failed after sending: {command}", innerException);
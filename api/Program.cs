@@ -23,16 +23,16 @@ builder.Host.UseSerilog((ctx, cfg) => cfg.ReadFrom.Configuration(ctx.Configurati
 
 // Database
 builder.Services.AddDbContext<AppDbContext>(opt =>
-    opt.UseSqlite(builder.Configuration.GetConnectionString("Default") ?? "Data Source=data/kvtm.db"));
+    opt.UseSqlite(builder.Configuration.GetConnectionString("Default") ?? "Data Source=data/kvtm.db")
+        .AddInterceptors(new SqlitePragmaInterceptor()));
 
 // Infrastructure services
 builder.Services.AddSingleton<AdbController>();
 builder.Services.AddSingleton<ImageMatcher>();
 
 // Feature services
-builder.Services.AddHostedService<DeviceManager>();
-builder.Services.AddSingleton<DeviceManager>(sp =>
-    (DeviceManager)sp.GetServices<IHostedService>().First(s => s is DeviceManager));
+builder.Services.AddSingleton<DeviceManager>();
+builder.Services.AddHostedService(sp => sp.GetRequiredService<DeviceManager>());
 builder.Services.AddSingleton<ScriptManager>();
 builder.Services.AddSingleton<ExecutionManager>();
 
@@ -59,6 +59,8 @@ using (var scope = app.Services.CreateScope())
 {
     var db = scope.ServiceProvider.GetRequiredService<AppDbContext>();
     db.Database.EnsureCreated();
+    // journal_mode is stored in the database file, so setting it once is enough
+    db.Database.ExecuteSqlRaw("PRAGMA journal_mode=WAL;");
 }
 
 // OpenAPI endpoint